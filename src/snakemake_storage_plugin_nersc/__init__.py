@@ -1,8 +1,18 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from pathlib import Path, PurePosixPath
-from typing import Any, Iterable, List, Optional
+import asyncio
+import errno
+import functools
+import os
+import posixpath
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_storage_plugins.io import IOCacheStorageInterface
@@ -18,7 +28,232 @@ from snakemake_interface_storage_plugins.storage_provider import (
     StorageProviderBase,
     StorageQueryValidationResult,
 )
-from snakemake_interface_storage_plugins.io import get_constant_prefix
+from snakemake_interface_storage_plugins.io import Mtime, get_constant_prefix
+
+# Buffer size used when streaming files out of the read-only mount. Buffers
+# are only needed when the kernel cannot copy, and are kept per thread.
+_COPY_BUFSIZE = 1024 * 1024
+_copy_buffers = threading.local()
+
+# Directory trees are walked with a thread pool once they fan out into more
+# than _PARALLEL_MIN_SUBDIRS subdirectories, and copied with it once they hold
+# more than _PARALLEL_MIN_FILES files. Metadata and read latency on networked
+# filesystems is what dominates here, and the in-kernel copies release the GIL,
+# so threads are sufficient. The pool is shared and only created when needed.
+_PARALLEL_MIN_SUBDIRS = 4
+_PARALLEL_MIN_FILES = 32
+_MAX_WORKERS = 16
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+# Directory listings for glob candidates are cached keyed by the directory's
+# mtime, which changes whenever entries are added, removed or renamed.
+# Directories modified within the last _LISTING_MIN_AGE seconds are listed
+# afresh, as coarse timestamps (1 s on Lustre) could hide a later change.
+_LISTING_MIN_AGE = 2.0
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    """Return the shared thread pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=_MAX_WORKERS, thread_name_prefix="nersc-storage"
+            )
+        return _pool
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+
+def _sendfile(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+def _kernel_copies() -> List[Callable[[int, int, int], int]]:
+    """Return the in-kernel copy strategies available, in order of preference.
+
+    They advance the file offsets and return the number of bytes copied (0 at
+    EOF). Only Linux supports both of them between regular files, and Python
+    builds against an older libc lack os.copy_file_range.
+    """
+    if sys.platform != "linux":
+        return []
+    copies = []
+    if hasattr(os, "copy_file_range"):
+        copies.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        copies.append(_sendfile)
+    return copies
+
+
+_KERNEL_COPIES = _kernel_copies()
+_KERNEL_COPY_CHUNK = 64 * 1024 * 1024
+# Errors signalling that an in-kernel copy is not possible for these files.
+_KERNEL_COPY_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+}
+
+
+def _dir_size(path: str, parallel: bool = False) -> int:
+    """Return the total size of the files below a physical directory.
+
+    Entry types come from the directory listing itself, so only one stat
+    call per file is needed. With parallel=True, the subdirectories of a
+    wide top level are walked concurrently.
+    """
+    total = 0
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                total += entry.stat().st_size
+
+    if parallel and len(subdirs) > _PARALLEL_MIN_SUBDIRS:
+        total += sum(_get_pool().map(_dir_size, subdirs))
+    else:
+        total += sum(_dir_size(subdir) for subdir in subdirs)
+    return total
+
+
+def _plan_copy(src: str, dst: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """Collect what is needed to copy a physical directory tree to dst.
+
+    Returns the destination directories to create (parents first) and the
+    (source, destination) pairs of all files, gathered in one scandir walk.
+    """
+    dirs = [dst]
+    files = []
+    stack = [(src, dst)]
+    while stack:
+        src_dir, dst_dir = stack.pop()
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                target = os.path.join(dst_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(target)
+                    stack.append((entry.path, target))
+                elif entry.is_dir():
+                    # Symlinked directories are not descended into.
+                    dirs.append(target)
+                else:
+                    files.append((entry.path, target))
+    return dirs, files
+
+
+def _copy_buffer() -> bytearray:
+    """Return this thread's buffer for userspace copies, allocating it lazily."""
+    buf = getattr(_copy_buffers, "buf", None)
+    if buf is None:
+        buf = _copy_buffers.buf = bytearray(_COPY_BUFSIZE)
+    return buf
+
+
+def _copy_file(src: str, dst: str) -> None:
+    """Copy a file, letting the kernel move the data where possible.
+
+    copy_file_range() is tried first, as it can clone data on filesystems
+    that support it, then sendfile(). If neither is supported for this pair
+    of files, the remainder is streamed through a bounded buffer in userspace.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            size = os.fstat(src_fd).st_size
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            copied = 0
+            for kernel_copy in _KERNEL_COPIES:
+                try:
+                    while n := kernel_copy(src_fd, dst_fd, _KERNEL_COPY_CHUNK):
+                        copied += n
+                except OSError as e:
+                    if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                        raise
+                # Some filesystems report EOF right away instead of failing,
+                # hence check whether everything has been copied.
+                if copied >= size:
+                    return
+
+            # Both calls leave the file offsets after the copied data.
+            buf = _copy_buffer()
+            view = memoryview(buf)
+            while n := os.readv(src_fd, [buf]):
+                written = 0
+                while written < n:
+                    written += os.write(dst_fd, view[written:n])
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _copy_files(files: List[Tuple[str, str]]) -> None:
+    """Copy (source, destination) pairs sequentially."""
+    for src, dst in files:
+        _copy_file(src, dst)
+
+
+def _copy_files_parallel(files: List[Tuple[str, str]]) -> None:
+    """Copy (source, destination) pairs, spreading many files over threads."""
+    if len(files) <= _PARALLEL_MIN_FILES:
+        _copy_files(files)
+        return
+    batches = [files[i::_MAX_WORKERS] for i in range(_MAX_WORKERS)]
+    # Consume the results so that errors in any batch are raised.
+    list(_get_pool().map(_copy_files, batches))
+
+
+def _list_dir(path: str) -> Tuple[Tuple[str, bool], ...]:
+    """Return the (name, is_dir) pairs of a physical directory."""
+    with os.scandir(path) as it:
+        return tuple((entry.name, entry.is_dir(follow_symlinks=False)) for entry in it)
+
+
+@functools.lru_cache(maxsize=4096)
+def _list_dir_cached(path: str, mtime_ns: int) -> Tuple[Tuple[str, bool], ...]:
+    """Return the listing of a directory, cached per directory mtime."""
+    return _list_dir(path)
+
+
+def _list_prefix(path: str, name_prefix: str = "") -> List[str]:
+    """List everything below a physical directory, recursively.
+
+    Only top-level entries whose name starts with name_prefix are considered.
+    Entry types come from the directory listing, so no per-entry stat calls
+    are needed; symlinked directories are not descended into. Listings of
+    unchanged directories are reused from previous calls.
+    """
+    paths = []
+    stack = [(path, name_prefix)]
+    while stack:
+        dir_path, prefix = stack.pop()
+        try:
+            stat = os.stat(dir_path)
+            if time.time() - stat.st_mtime < _LISTING_MIN_AGE:
+                listing = _list_dir(dir_path)
+            else:
+                listing = _list_dir_cached(dir_path, stat.st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for name, is_dir in listing:
+            if not name.startswith(prefix):
+                continue
+            entry_path = os.path.join(dir_path, name)
+            paths.append(entry_path)
+            if is_dir:
+                stack.append((entry_path, ""))
+    return paths
 
 
 @dataclass
@@ -34,20 +269,107 @@ class StorageProviderSettings(StorageProviderSettingsBase):
         the read-only mount is significantly more performant (e.g. globbing).
         Defaults to "/dvs_ro" (NERSC read-only mirror).
 
-    By overriding these in tests or other environments, the plugin can be
+    stat_cache_ttl:
+        Number of seconds for which a storage object reuses its stat result
+        across exists(), mtime() and size() calls. Defaults to 0.5; set to 0
+        to always query the filesystem.
+
+    By overriding the roots in tests or other environments, the plugin can be
     used without requiring real /global or /dvs_ro mounts.
     """
 
-    logical_root: Optional[str] = None
-    physical_ro_root: Optional[str] = None
+    logical_root: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Logical root prefix seen in queries (default: /global).",
+        },
+    )
+    physical_ro_root: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Physical read-only root the logical root is mapped to "
+            "(default: /dvs_ro).",
+        },
+    )
+    stat_cache_ttl: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Seconds for which a storage object reuses its stat result "
+            "(default: 0.5). Set to 0 to always query the filesystem.",
+            "type": float,
+        },
+    )
+
+    def __post_init__(self):
+        # Apply the NERSC defaults and normalize trailing slashes once, instead
+        # of for every storage object.
+        self.logical_root = (self.logical_root or "/global").rstrip("/") or "/"
+        self.physical_ro_root = (self.physical_ro_root or "/dvs_ro").rstrip("/") or "/"
+        if self.stat_cache_ttl is None:
+            self.stat_cache_ttl = 0.5
 
 
 class StorageProvider(StorageProviderBase):
     # Do not override __init__; use __post_init__ instead.
 
     def __post_init__(self):
-        # Nothing to initialize for this simple mapping provider.
-        pass
+        # Resolve the roots from the settings once, so that storage objects do
+        # not have to repeat this for every query.
+        settings: StorageProviderSettings = self.settings  # type: ignore[assignment]
+        self._logical_root = settings.logical_root
+        self._physical_ro_root = settings.physical_ro_root
+        # With the trailing separator, mapping a path between the roots is a
+        # single startswith() check plus a concatenation.
+        self._logical_prefix = self._logical_root.rstrip("/") + "/"
+        self._physical_prefix = self._physical_ro_root.rstrip("/") + "/"
+        self._stat_cache_ttl = settings.stat_cache_ttl
+
+        # Directory scans currently running in worker threads. Finished scans
+        # are not kept: their results live in Snakemake's IOCache.
+        self._pending_scans: Dict[str, asyncio.Future] = {}
+
+    def _scan_dir(self, path: str) -> List[Tuple[str, os.stat_result]]:
+        """Stat all entries of a physical directory in a single scandir pass.
+
+        Returns the paths of the entries along with their stat results.
+        """
+        entries = []
+        try:
+            dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except (FileNotFoundError, NotADirectoryError):
+            # A missing parent means that none of its children exist.
+            dir_fd = None
+
+        if dir_fd is not None:
+            try:
+                # Listing through the open directory makes entry.stat() an
+                # fstatat() relative to it, so the kernel does not walk the
+                # full path again for every entry.
+                with os.scandir(dir_fd) as it:
+                    for entry in it:
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            # Dangling symlink or entry removed while scanning.
+                            continue
+                        entries.append((os.path.join(path, entry.name), stat))
+            finally:
+                os.close(dir_fd)
+
+        return entries
+
+    async def _scan_dir_async(self, path: str) -> List[Tuple[str, os.stat_result]]:
+        """Scan a physical directory in a worker thread.
+
+        Concurrent calls for the same directory share a single scan.
+        """
+        scan = self._pending_scans.get(path)
+        if scan is None:
+            scan = asyncio.ensure_future(asyncio.to_thread(self._scan_dir, path))
+            self._pending_scans[path] = scan
+            scan.add_done_callback(lambda _: self._pending_scans.pop(path, None))
+        # Do not let a cancelled caller cancel the scan for the others.
+        return await asyncio.shield(scan)
 
     @classmethod
     def example_queries(cls) -> List[ExampleQuery]:
@@ -88,61 +410,94 @@ class StorageProvider(StorageProviderBase):
 
     def postprocess_query(self, query: str) -> str:
         # Normalize the query path (POSIX semantics, without filesystem access).
-        return str(PurePosixPath(query))
+        return posixpath.normpath(query)
 
     def safe_print(self, query: str) -> str:
         """Process the query to remove potentially sensitive information when printing."""
         # No sensitive information in this simple implementation.
-        return str(PurePosixPath(query))
+        return posixpath.normpath(query)
 
 
 class StorageObject(StorageObjectRead, StorageObjectGlob):
     # Do not override __init__; use __post_init__ instead.
 
     def __post_init__(self):
-        # Cache roots from provider settings, with NERSC defaults.
-        settings: StorageProviderSettings = self.provider.settings  # type: ignore[assignment]
-        self._logical_root = PurePosixPath(settings.logical_root or "/global")
-        self._physical_ro_root = PurePosixPath(settings.physical_ro_root or "/dvs_ro")
-
-    def _to_read_only(self) -> Path:
-        """Map the logical query path to the physical read-only root."""
-        query = PurePosixPath(self.query)
-
-        try:
-            rel = query.relative_to(self._logical_root)
-        except ValueError:
-            # If the query does not start with the logical root, fall back to
-            # using it as-is. This should not normally happen if queries are
-            # validated and constructed consistently.
-            return Path(str(query))
-
-        return Path(str(self._physical_ro_root / rel))
+        # Roots are resolved once by the provider.
+        self._logical_root = self.provider._logical_root
+        self._physical_ro_root = self.provider._physical_ro_root
+        self._logical_prefix = self.provider._logical_prefix
+        self._physical_prefix = self.provider._physical_prefix
+        # The query is fixed for the lifetime of the object, so map it once
+        # instead of on every metadata call.
+        self._real_path = self._to_read_only()
+        self._real_parent = os.path.dirname(self._real_path)
+        # Snakemake usually asks for existence, mtime and size of an object in
+        # quick succession, so the last stat result is reused for a short time.
+        self._stat_cache: Optional[os.stat_result] = None
+        self._stat_cache_time: Optional[float] = None
+
+    def _to_read_only(self, query: Optional[str] = None) -> str:
+        """Map a logical path (the query by default) to the physical read-only root."""
+        if query is None:
+            query = self.query
+
+        if query.startswith(self._logical_prefix):
+            return self._physical_prefix + query[len(self._logical_prefix) :]
+        if query == self._logical_root:
+            return self._physical_ro_root
+        # If the query does not start with the logical root, fall back to
+        # using it as-is. This should not normally happen if queries are
+        # validated and constructed consistently.
+        return query
 
     def _to_original(self, path: str) -> str:
         """Map a physical path back to the logical namespace for globbing."""
-        physical = PurePosixPath(path)
-
-        try:
-            rel = physical.relative_to(self._physical_ro_root)
-        except ValueError:
-            return str(physical)
-
-        return str(self._logical_root / rel)
+        if path.startswith(self._physical_prefix):
+            return self._logical_prefix + path[len(self._physical_prefix) :]
+        if path == self._physical_ro_root:
+            return self._logical_root
+        return path
 
     async def inventory(self, cache: IOCacheStorageInterface):
-        """Populate IOCache with existence and mtime information if available.
+        """Populate IOCache with existence, mtime and size information.
 
-        The IOCache interface in snakemake-interface-storage-plugins 4.x does not
-        expose setters here, so we simply perform the checks to ensure that
-        inventory can be called without raising, and let Snakemake fall back to
-        direct exists()/mtime() calls when needed.
+        The parent directory is scanned once and all of its entries are added
+        to the cache, so that sibling objects do not need to be checked one
+        by one.
         """
-        return None
+        parent = self.get_inventory_parent()
+        # Snakemake's IOCache tracks which parents have been inventoried, which
+        # also lets it treat unlisted siblings as non-existing.
+        has_inventory = getattr(cache.exists_in_storage, "has_inventory", None)
+        if has_inventory is not None and parent in has_inventory:
+            return
+
+        provider: StorageProvider = self.provider  # type: ignore[assignment]
+        try:
+            # Wait for the filesystem without blocking the event loop.
+            entries = await provider._scan_dir_async(parent)
+        except OSError:
+            # E.g. a parent that may be traversed but not listed (mode o+x
+            # without o+r). Leave the cache empty, so that Snakemake falls
+            # back to exists() and mtime().
+            return
+        for path, stat in entries:
+            key = self.cache_key(self._to_original(path))
+            cache.exists_in_storage[key] = True
+            cache.mtime[key] = Mtime(storage=stat.st_mtime)
+            if S_ISREG(stat.st_mode):
+                # Directory sizes are computed recursively by size().
+                cache.size[key] = stat.st_size
+
+        key = self.cache_key()
+        if key not in cache.exists_in_storage:
+            cache.exists_in_storage[key] = False
+        if has_inventory is not None:
+            has_inventory.add(parent)
 
     def get_inventory_parent(self) -> Optional[str]:
         """Return the parent directory of this object."""
-        return str(self._to_read_only().parent)
+        return self._real_parent
 
     def local_suffix(self) -> str:
         """Return a unique suffix for the local path, determined from self.query."""
@@ -154,33 +509,52 @@ class StorageObject(StorageObjectRead, StorageObjectGlob):
         # Nothing special to do; Snakemake handles removal of local_path().
         return None
 
-    @retry_decorator
+    def _stat(self) -> Optional[os.stat_result]:
+        """Return the stat result of the physical path, or None if missing.
+
+        Reuses the object's last result if it is younger than the configured
+        stat_cache_ttl, otherwise makes a single os.stat() call on the plain
+        path. Inventory results are not consulted here: Snakemake only calls
+        exists() and mtime() when its IOCache has no answer.
+        """
+        now = time.monotonic()
+        if (
+            self._stat_cache_time is not None
+            and now - self._stat_cache_time < self.provider._stat_cache_ttl
+        ):
+            return self._stat_cache
+
+        try:
+            stat = os.stat(self._real_path)
+        except (FileNotFoundError, NotADirectoryError):
+            stat = None
+
+        self._stat_cache = stat
+        self._stat_cache_time = now
+        return stat
+
+    # Metadata calls are not retried: a missing object is an answer, not a
+    # transient failure.
     def exists(self) -> bool:
-        return self._to_read_only().exists()
+        return self._stat() is not None
 
-    @retry_decorator
     def mtime(self) -> float:
-        real_path = self._to_read_only()
-        try:
-            return real_path.stat().st_mtime
-        except FileNotFoundError as e:
-            raise WorkflowError(f"Object does not exist: {self.query}") from e
+        stat = self._stat()
+        if stat is None:
+            raise WorkflowError(f"Object does not exist: {self.query}")
+        return stat.st_mtime
 
-    @retry_decorator
     def size(self) -> int:
-        real_path = self._to_read_only()
-        try:
-            if real_path.is_dir():
-                total = 0
-                for p in real_path.rglob("*"):
-                    if p.is_file():
-                        total += p.stat().st_size
-                return total
-            return real_path.stat().st_size
-        except FileNotFoundError as e:
-            raise WorkflowError(f"Object does not exist: {self.query}") from e
+        stat = self._stat()
+        if stat is None:
+            raise WorkflowError(f"Object does not exist: {self.query}")
+        if S_ISDIR(stat.st_mode):
+            try:
+                return _dir_size(self._real_path, parallel=True)
+            except FileNotFoundError as e:
+                raise WorkflowError(f"Object does not exist: {self.query}") from e
+        return stat.st_size
 
-    @retry_decorator
     def local_footprint(self) -> int:
         # For this simple implementation, local footprint equals size.
         return self.size()
@@ -188,34 +562,37 @@ class StorageObject(StorageObjectRead, StorageObjectGlob):
     @retry_decorator
     def retrieve_object(self):
         """Ensure that the object is accessible locally under self.local_path()."""
-        src = self._to_read_only()
+        src = self._real_path
         dst = Path(self.local_path())
 
-        if not src.exists():
+        # Do not rely on a stat result from before the copy was requested.
+        self._stat_cache_time = None
+        stat = self._stat()
+        if stat is None:
             raise WorkflowError(f"Cannot retrieve non-existing object: {self.query}")
 
         dst.parent.mkdir(parents=True, exist_ok=True)
 
-        if src.is_dir():
-            # Simple recursive copy for directories.
-            for p in src.rglob("*"):
-                rel = p.relative_to(src)
-                target = dst / rel
-                if p.is_dir():
-                    target.mkdir(parents=True, exist_ok=True)
-                else:
-                    target.parent.mkdir(parents=True, exist_ok=True)
-                    target.write_bytes(p.read_bytes())
+        if S_ISDIR(stat.st_mode):
+            # Plan the whole tree in one walk, then create all directories
+            # before copying the files.
+            dirs, files = _plan_copy(src, str(dst))
+            for d in dirs:
+                os.makedirs(d, exist_ok=True)
+            _copy_files_parallel(files)
         else:
-            dst.write_bytes(src.read_bytes())
+            _copy_files([(src, str(dst))])
 
     @retry_decorator
     def list_candidate_matches(self) -> Iterable[str]:
         """Return a list of candidate matches in the storage for the query."""
         # This is used by glob_wildcards() to find matches for wildcards in the query.
         # The method has to return concretized queries without any remaining wildcards.
-        prefix = self._to_read_only(Path(get_constant_prefix(self.query)))
-        if prefix.is_dir():
-            return map(str, prefix.rglob("*"))
-        else:
-            return (prefix,)
+        # Wildcards may span several directory levels, so everything below the
+        # constant prefix is a candidate; Snakemake filters them afterwards.
+        parent, name_prefix = get_constant_prefix(self.query).rsplit("/", 1)
+        physical_parent = self._to_read_only(parent or "/")
+        return [
+            self._to_original(path)
+            for path in _list_prefix(physical_parent, name_prefix)
+        ]
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+
+def _tmpfs_dir() -> Optional[str]:
+    """Return a writable tmpfs directory, if the platform provides one.
+
+    NERSC_TEST_TMPFS can point to a different memory-backed directory.
+    """
+    path = os.environ.get("NERSC_TEST_TMPFS", "/dev/shm")
+    if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+        return path
+    return None
+
+
+@pytest.fixture(scope="session")
+def nersc_test_base(tmp_path_factory):
+    """Base directory for the simulated NERSC roots.
+
+    Fixture files are created on tmpfs where available, so that setting them
+    up and stat'ing them does not hit the disk. Otherwise, pytest's temporary
+    directory is used.
+    """
+    tmpfs = _tmpfs_dir()
+    if tmpfs is None:
+        yield tmp_path_factory.mktemp("nersc")
+        return
+
+    base = Path(tempfile.mkdtemp(dir=tmpfs, prefix="nersc_test_"))
+    try:
+        yield base
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def nersc_fixture_root(nersc_test_base: Path) -> Path:
+    """Simulated /dvs_ro root shared by all tests that only read from it.
+
+    Fixture files are created in it on first use and reused afterwards, so
+    that their directories are not set up again for every test.
+    """
+    root = nersc_test_base / "dvs_ro"
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+@pytest.fixture(scope="session")
+def nersc_canonical_file(nersc_test_base: Path) -> Path:
+    """Canonical fixture file, written once and linked into the test roots."""
+    path = nersc_test_base / ".canonical" / "test.txt"
+    try:
+        os.mkdir(path.parent)
+    except FileExistsError:
+        pass
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        # Written before; keep it instead of truncating and rewriting it.
+        pass
+    else:
+        try:
+            os.write(fd, b"hello nersc")
+        finally:
+            os.close(fd)
+    return path
+
+
+@pytest.fixture(scope="session", autouse=True)
+def nersc_test_env():
+    """Environment shared by all tests, set once per session.
+
+    DVS does not support file locking, so HDF5 locking is disabled as it
+    has to be on /dvs_ro.
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("HDF5_USE_FILE_LOCKING", "FALSE")
+        yield
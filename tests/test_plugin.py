@@ -1,15 +1,59 @@
+import asyncio
+import errno
+import logging
+import os
+import tempfile
+import time
 from pathlib import Path
 from typing import Optional, Type
+from unittest import mock
 
 import pytest
+from snakemake.io import IOCache
 from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
 from snakemake_interface_storage_plugins.storage_provider import StorageProviderBase
 from snakemake_interface_storage_plugins.tests import TestStorageBase
 
+import snakemake_storage_plugin_nersc as nersc
 from snakemake_storage_plugin_nersc import StorageProvider, StorageProviderSettings
 
+# Paths of the test queries relative to the simulated roots. These are plain
+# strings, so that the fixture helpers can stay on os.path.
+DATA_REL_PATH = os.path.join("cfs", "cdirs", "myproject", "data")
+QUERY_REL_PATH = os.path.join(DATA_REL_PATH, "test.txt")
+QUERY_NOT_EXISTING_REL_PATH = os.path.join(DATA_REL_PATH, "does_not_exist.txt")
+
+
+def _link_fixture(src: str, dst: str):
+    """Make dst a link to the fixture file src, if it does not exist yet.
+
+    Hard links are used where possible, symlinks across devices.
+    """
+    for attempt in range(2):
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            if attempt:
+                raise
+            # Create the parent directories on first use only.
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            continue
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            os.symlink(src, dst)
+        return
+
 
 class TestStorage(TestStorageBase):
+    """Tests of the NERSC storage plugin against simulated /global and /dvs_ro roots.
+
+    DVS does not support file locking, so the plugin must never take fcntl
+    locks on files below the read-only root (see test_retrieve_takes_no_locks).
+    """
+
     __test__ = True
     # set to True if the storage is read-only
     retrieve_only = True
@@ -25,41 +69,336 @@ class TestStorage(TestStorageBase):
     files_only = True
 
     @pytest.fixture(autouse=True)
-    def _init_test_roots(self, tmp_path: Path):
-        """Initialize per-test roots under pytest's tmp_path.
+    def _init_test_roots(
+        self,
+        nersc_test_base: Path,
+        nersc_fixture_root: Path,
+        nersc_canonical_file: Path,
+    ):
+        """Initialize the roots below the (tmpfs-backed) test base.
 
         The base test harness may call get_storage_provider_settings() before
-        get_query(), so we must ensure the roots are available early.
+        get_query(), so we must ensure the roots are available early. The
+        physical root is shared across tests; retrieved copies end up below
+        the logical root, which is created per test.
         """
-        self._test_physical_root = (tmp_path / "dvs_ro").resolve()
-        self._test_logical_root = (tmp_path / "global").resolve()
-
-        self._test_physical_root.mkdir(parents=True, exist_ok=True)
-        self._test_logical_root.mkdir(parents=True, exist_ok=True)
+        self._test_base = nersc_test_base
+        self._canonical_file = str(nersc_canonical_file)
+        self._test_physical_root = nersc_fixture_root
+        self._test_logical_root = Path(
+            tempfile.mkdtemp(dir=nersc_test_base, prefix="global_")
+        ).resolve()
 
         yield
 
+    @pytest.fixture
+    def isolated_roots(self):
+        """Give the test its own physical root, for tests that modify it."""
+        self._test_physical_root = Path(
+            tempfile.mkdtemp(dir=self._test_base, prefix="dvs_ro_")
+        ).resolve()
+
     def get_query(self, tmp_path) -> str:
-        # Create a file under the simulated physical root.
-        rel_path = Path("cfs") / "cdirs" / "myproject" / "data" / "test.txt"
-        real_path = self._test_physical_root / rel_path
-        real_path.parent.mkdir(parents=True, exist_ok=True)
-        real_path.write_text("hello nersc")
+        # Link the canonical file under the simulated physical root, unless an
+        # earlier test sharing the root already did.
+        _link_fixture(
+            self._canonical_file, os.path.join(self._test_physical_root, QUERY_REL_PATH)
+        )
 
         # Return a logical query under the simulated logical root.
-        return str(self._test_logical_root / rel_path)
+        return os.path.join(self._test_logical_root, QUERY_REL_PATH)
 
     def get_query_not_existing(self, tmp_path) -> str:
-        rel_path = Path("cfs") / "cdirs" / "myproject" / "data" / "does_not_exist.txt"
-        return str(self._test_logical_root / rel_path)
+        return os.path.join(self._test_logical_root, QUERY_NOT_EXISTING_REL_PATH)
 
     def get_storage_provider_cls(self) -> Type[StorageProviderBase]:
         # Return the StorageProvider class of this plugin
         return StorageProvider
 
     def get_storage_provider_settings(self) -> Optional[StorageProviderSettingsBase]:
-        # Use tmp_path-based roots initialized by the autouse fixture.
+        # Use the roots initialized by the autouse fixture.
         return StorageProviderSettings(
             logical_root=str(self._test_logical_root),
             physical_ro_root=str(self._test_physical_root),
         )
+
+    @pytest.mark.usefixtures("isolated_roots")
+    def test_inventory_populates_siblings(self, tmp_path):
+        query = self.get_query(tmp_path)
+        sibling = Path(query).with_name("sibling.txt")
+        real_sibling = self._test_physical_root / sibling.relative_to(
+            self._test_logical_root
+        )
+        real_sibling.write_text("hello sibling")
+
+        provider = self._get_provider(tmp_path)
+        obj = provider.object(query)
+        cache = IOCache(max_wait_time=10)
+        asyncio.run(obj.inventory(cache))
+
+        sibling_key = obj.cache_key(str(sibling))
+        assert cache.exists_in_storage[sibling_key]
+        assert cache.size[sibling_key] == len("hello sibling")
+        assert provider.object(str(sibling)).exists()
+        assert not provider.object(self.get_query_not_existing(tmp_path)).exists()
+
+    @pytest.mark.usefixtures("isolated_roots")
+    def test_changes_after_inventory_are_seen(self, tmp_path):
+        query = self.get_query(tmp_path)
+        real_path = self._test_physical_root / QUERY_REL_PATH
+        real_sibling = real_path.with_name("sibling.txt")
+        sibling = Path(query).with_name("sibling.txt")
+
+        provider = self._get_provider(tmp_path)
+        asyncio.run(provider.object(query).inventory(IOCache(max_wait_time=10)))
+
+        real_sibling.write_text("hello sibling")
+        os.utime(real_sibling, (1, 1))
+        assert provider.object(str(sibling)).exists()
+        assert provider.object(str(sibling)).mtime() == 1
+
+        real_path.unlink()
+        assert not provider.object(query).exists()
+
+    def test_path_below_file_does_not_exist(self, tmp_path):
+        query = os.path.join(self.get_query(tmp_path), "sub")
+        obj = self._get_provider(tmp_path).object(query)
+        assert not obj.exists()
+
+    @pytest.mark.usefixtures("isolated_roots")
+    @pytest.mark.skipif(
+        hasattr(os, "geteuid") and os.geteuid() == 0,
+        reason="root can list any directory",
+    )
+    def test_inventory_of_unlistable_parent(self, tmp_path):
+        query = self.get_query(tmp_path)
+        real_dir = self._test_physical_root / DATA_REL_PATH
+        provider = self._get_provider(tmp_path)
+        obj = provider.object(query)
+        cache = IOCache(max_wait_time=10)
+
+        # Traversable, but not listable.
+        real_dir.chmod(0o300)
+        try:
+            asyncio.run(obj.inventory(cache))
+            assert obj.exists()
+        finally:
+            real_dir.chmod(0o755)
+
+        assert obj.cache_key() not in cache.exists_in_storage
+        assert obj.get_inventory_parent() not in cache.exists_in_storage.has_inventory
+
+    @pytest.mark.usefixtures("isolated_roots")
+    def test_list_candidate_matches(self, tmp_path):
+        query = self.get_query(tmp_path)
+        data_dir = Path(query).parent
+        (self._test_physical_root / "cfs" / "cdirs" / "myproject" / "other").mkdir()
+
+        provider = self._get_provider(tmp_path)
+        obj = provider.object(str(data_dir / "{name}.txt"))
+        assert list(obj.list_candidate_matches()) == [query]
+
+        obj = provider.object(str(data_dir.parent / "data{suffix}"))
+        assert sorted(obj.list_candidate_matches()) == [str(data_dir), query]
+
+    @pytest.mark.usefixtures("isolated_roots")
+    def test_list_candidate_matches_cache_invalidation(self, tmp_path):
+        query = self.get_query(tmp_path)
+        real_dir = self._test_physical_root / Path(query).parent.relative_to(
+            self._test_logical_root
+        )
+        # Age the directory so that its listing may be cached.
+        os.utime(real_dir, (0, 0))
+
+        provider = self._get_provider(tmp_path)
+        obj = provider.object(str(Path(query).parent / "{name}.txt"))
+        assert list(obj.list_candidate_matches()) == [query]
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            # The unchanged directory is not listed again.
+            assert list(obj.list_candidate_matches()) == [query]
+            assert scandir.call_count == 0
+
+            (real_dir / "new.txt").write_text("new")
+            # Age the directory again, so that the new listing is cached under
+            # the changed mtime instead of bypassing the cache.
+            os.utime(real_dir, (1, 1))
+            assert sorted(obj.list_candidate_matches()) == [
+                str(Path(query).with_name("new.txt")),
+                query,
+            ]
+            assert scandir.call_count == 1
+
+    @pytest.mark.usefixtures("isolated_roots")
+    @pytest.mark.parametrize("inventoried", [False, True])
+    @pytest.mark.parametrize("ttl, created_seen", [(60, False), (0, True)])
+    def test_stat_cache_ttl(self, tmp_path, ttl, created_seen, inventoried):
+        query = self.get_query_not_existing(tmp_path)
+        real_path = self._test_physical_root / Path(query).relative_to(
+            self._test_logical_root
+        )
+        real_path.parent.mkdir(parents=True, exist_ok=True)
+
+        provider = StorageProvider(
+            logger=logging.getLogger(__name__),
+            local_prefix=tmp_path / "local_prefix",
+            settings=StorageProviderSettings(
+                logical_root=str(self._test_logical_root),
+                physical_ro_root=str(self._test_physical_root),
+                stat_cache_ttl=ttl,
+            ),
+        )
+        obj = provider.object(query)
+        if inventoried:
+            asyncio.run(obj.inventory(IOCache(max_wait_time=10)))
+        assert not obj.exists()
+        real_path.write_text("created")
+        assert obj.exists() == created_seen
+
+    @pytest.mark.usefixtures("isolated_roots")
+    def test_inventory_is_batched(self, tmp_path):
+        names = [f"file_{i}.txt" for i in range(1000)]
+        real_dir = os.path.join(self._test_physical_root, DATA_REL_PATH)
+        for name in names:
+            _link_fixture(self._canonical_file, os.path.join(real_dir, name))
+
+        provider = self._get_provider(tmp_path)
+        objs = [
+            provider.object(str(self._test_logical_root / DATA_REL_PATH / name))
+            for name in names
+        ]
+        cache = IOCache(max_wait_time=10)
+
+        async def inventory_all():
+            # Snakemake awaits the inventory of each input one after another.
+            for obj in objs:
+                await obj.inventory(cache)
+
+        with (
+            mock.patch("os.stat", wraps=os.stat) as stat,
+            mock.patch("os.scandir", wraps=os.scandir) as scandir,
+        ):
+            asyncio.run(inventory_all())
+
+        # One directory scan answers for all objects, without per-file stat calls.
+        assert scandir.call_count == 1
+        assert stat.call_count == 0
+        for obj in objs:
+            key = obj.cache_key()
+            assert cache.exists_in_storage[key]
+            assert cache.size[key] == len("hello nersc")
+
+    @pytest.mark.usefixtures("isolated_roots")
+    def test_concurrent_inventory_scans_once(self, tmp_path):
+        query = self.get_query(tmp_path)
+        provider = self._get_provider(tmp_path)
+        objs = [
+            provider.object(query),
+            provider.object(self.get_query_not_existing(tmp_path)),
+        ]
+        cache = IOCache(max_wait_time=10)
+
+        async def inventory_all():
+            await asyncio.gather(*(obj.inventory(cache) for obj in objs))
+
+        real_scandir = os.scandir
+
+        def slow_scandir(path):
+            # Keep the first scan running while the second inventory starts.
+            time.sleep(0.1)
+            return real_scandir(path)
+
+        with mock.patch("os.scandir", side_effect=slow_scandir) as scandir:
+            asyncio.run(inventory_all())
+
+        assert scandir.call_count == 1
+        assert cache.exists_in_storage[objs[0].cache_key()]
+        assert not cache.exists_in_storage[objs[1].cache_key()]
+
+    @pytest.mark.usefixtures("isolated_roots")
+    @pytest.mark.parametrize(
+        "subdirs, files_per_dir, parallel",
+        # Below and above _PARALLEL_MIN_SUBDIRS and _PARALLEL_MIN_FILES.
+        [(2, 3, False), (6, 10, True)],
+    )
+    def test_directory(self, tmp_path, subdirs, files_per_dir, parallel):
+        real_dir = self._test_physical_root / DATA_REL_PATH / "tree"
+        contents = {}
+        for i in range(subdirs):
+            for j in range(files_per_dir):
+                contents[f"sub_{i}/file_{j}.txt"] = f"content {i} {j}"
+        contents["top.txt"] = "top"
+        for rel_path, content in contents.items():
+            (real_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+            (real_dir / rel_path).write_text(content)
+        (real_dir / "empty").mkdir()
+
+        provider = self._get_provider(tmp_path)
+        obj = provider.object(str(self._test_logical_root / DATA_REL_PATH / "tree"))
+        with mock.patch.object(nersc, "_get_pool", wraps=nersc._get_pool) as pool:
+            assert obj.size() == sum(len(c) for c in contents.values())
+            obj.retrieve_object()
+        assert pool.called == parallel
+
+        local_dir = obj.local_path()
+        assert (local_dir / "empty").is_dir()
+        assert not any((local_dir / "empty").iterdir())
+        copied = {
+            str(path.relative_to(local_dir)): path.read_text()
+            for path in local_dir.rglob("*")
+            if path.is_file()
+        }
+        assert copied == contents
+
+    def test_retrieve_takes_no_locks(self, tmp_path):
+        assert os.environ["HDF5_USE_FILE_LOCKING"] == "FALSE"
+
+        obj = self._get_obj(tmp_path, self.get_query(tmp_path))
+        no_locking = AssertionError("no locking on dvs_ro")
+        with (
+            mock.patch("fcntl.flock", side_effect=no_locking),
+            mock.patch("fcntl.lockf", side_effect=no_locking),
+        ):
+            obj.retrieve_object()
+        assert obj.local_path().read_text() == "hello nersc"
+
+
+def _unsupported_copy(src_fd: int, dst_fd: int, count: int) -> int:
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+def _partial_copy(src_fd: int, dst_fd: int, count: int) -> int:
+    # Copy the first block, then fail as if the rest could not be copied.
+    if os.lseek(src_fd, 0, os.SEEK_CUR):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+    return os.write(dst_fd, os.read(src_fd, 4096))
+
+
+@pytest.mark.parametrize(
+    "kernel_copies",
+    [[], [_unsupported_copy], [_partial_copy]],
+    ids=["none", "unsupported", "partial"],
+)
+@pytest.mark.parametrize("size", [0, 2 * nersc._COPY_BUFSIZE + 123])
+def test_copy_file_userspace_fallback(tmp_path, monkeypatch, kernel_copies, size):
+    monkeypatch.setattr(nersc, "_KERNEL_COPIES", kernel_copies)
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    data = os.urandom(size)
+    src.write_bytes(data)
+
+    nersc._copy_file(str(src), str(dst))
+    assert dst.read_bytes() == data
+
+
+@pytest.mark.parametrize("missing", ["copy_file_range", "sendfile"])
+def test_copy_file_without_kernel_copy(tmp_path, monkeypatch, missing):
+    # Python builds against an older libc lack some of the copy functions.
+    monkeypatch.delattr(os, missing, raising=False)
+    monkeypatch.setattr(nersc, "_KERNEL_COPIES", nersc._kernel_copies())
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    data = os.urandom(2 * nersc._COPY_BUFSIZE + 123)
+    src.write_bytes(data)
+
+    nersc._copy_file(str(src), str(dst))
+    assert dst.read_bytes() == data